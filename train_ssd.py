@@ -4,7 +4,10 @@
 import os
 import sys
 import logging
+import logging.handlers
 import argparse
+import atexit
+import queue
 import itertools
 import torch
 from datetime import datetime as dt 
@@ -22,6 +25,8 @@ from vision.ssd.mobilenet_v2_ssd_lite import create_mobilenetv2_ssd_lite
 from vision.ssd.squeezenet_ssd_lite import create_squeezenet_ssd_lite
 from vision.datasets.voc_dataset import VOCDataset
 from vision.datasets.open_images import OpenImagesDataset
+from vision.datasets.collation import device_collate
+from vision.datasets.prefetcher import CUDAPrefetcher
 from vision.nn.multibox_loss import MultiboxLoss
 from vision.ssd.config import vgg_ssd_config
 from vision.ssd.config import mobilenetv1_ssd_config
@@ -37,6 +42,12 @@ parser.add_argument("--dataset-type", default="open_images", type=str,
 parser.add_argument('--datasets', '--data', nargs='+', default=["data"], help='Dataset directory path')
 parser.add_argument('--balance-data', action='store_true',
                     help="Balance training data by down-sampling more frequent labels.")
+parser.add_argument('--image-cache', action='store_true',
+                    help="Decode open_images images once into a memory mapped uint8 archive and train from it. "
+                         "Images are resized (without keeping the aspect ratio) to a 340x340 square first.")
+parser.add_argument('--preload-ram', action='store_true',
+                    help="Decode all open_images images into a shared memory tensor before training, if it fits in memory. "
+                         "Images are resized (without keeping the aspect ratio) to a 340x340 square first.")
 
 # Params for network
 parser.add_argument('--net', default="mb1-ssd",
@@ -92,8 +103,12 @@ parser.add_argument('--batch-size', default=4, type=int,
                     help='Batch size for training')
 parser.add_argument('--num-epochs', '--epochs', default=30, type=int,
                     help='the number epochs')
-parser.add_argument('--num-workers', '--workers', default=2, type=int,
+# throughput does not grow monotonically with the number of workers (GIL and IPC
+# contention), so default to half the cores, capped at 4
+parser.add_argument('--num-workers', '--workers', default=min((os.cpu_count() or 2) // 2, 4), type=int,
                     help='Number of workers used in dataloading')
+parser.add_argument('--worker-device-copy', action='store_true',
+                    help='Copy open_images samples to the GPU inside the dataloader workers (uses spawned workers)')
 parser.add_argument('--validation-epochs', default=1, type=int,
                     help='the number epochs between running validation')
 parser.add_argument('--checkpoint-epochs', default=1, type=int,
@@ -102,11 +117,44 @@ parser.add_argument('--debug-steps', default=10, type=int,
                     help='Set the debug log output frequency.')
 parser.add_argument('--use-cuda', default=True, type=str2bool,
                     help='Use CUDA to train model')
+parser.add_argument('--use-amp', default=True, type=str2bool,
+                    help='Use mixed precision (autocast + GradScaler) when training on CUDA')
+parser.add_argument('--cuda-graph', action='store_true',
+                    help='Capture the whole training step in a CUDA graph (CUDA only, disables AMP). '
+                         'Runs a few warm-up steps on the first batch at learning rate 0 before capturing.')
+parser.add_argument('--compile', action='store_true',
+                    help='Compile the network forward pass with torch.compile (requires PyTorch 2.0+)')
 parser.add_argument('--checkpoint-folder', '--model-dir', default='models/',
                     help='Directory for saving checkpoint models')
 
-logging.basicConfig(stream=sys.stdout, level=logging.INFO,
-                    format='%(asctime)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # the stock QueueHandler formats records in the logging thread, only
+    # the %-style interpolation of the arguments is left to the listener thread
+    def prepare(self, record):
+        if not isinstance(record.msg, str):
+            # objects such as datasets are rendered here, on the calling thread
+            record.msg = str(record.msg)
+        return record
+
+LOG_FORMAT = '%(asctime)s - %(message)s'
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+def start_log_listener():
+    # log records are formatted and written by a background thread so that
+    # stdout I/O never blocks the training loop
+    log_queue = queue.Queue(-1)
+    log_stream_handler = logging.StreamHandler(sys.stdout)
+    log_stream_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+    log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logging.basicConfig(level=logging.INFO, handlers=[DeferredQueueHandler(log_queue)])
+
+def init_worker_logging(worker_id):
+    # forked loader workers inherit the queue handler but not the listener
+    # thread, so their records would never be written; log straight to stdout
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format=LOG_FORMAT, datefmt=LOG_DATEFMT, force=True)
                     
 args = parser.parse_args()
 
@@ -114,61 +162,158 @@ DEVICE = torch.device("cuda:0" if torch.cuda.is_available() and args.use_cuda el
 
 if args.use_cuda and torch.cuda.is_available():
     torch.backends.cudnn.benchmark = True
-    logging.info("Using CUDA...")
+
+USE_CUDA_GRAPH = args.cuda_graph and DEVICE.type == 'cuda'
+# GradScaler syncs with the host in step(), so it cannot be captured in a graph
+USE_AMP = args.use_amp and DEVICE.type == 'cuda' and not USE_CUDA_GRAPH
 
 def get_current_lr(optimizer):
     for param_group in optimizer.param_groups:
         return param_group['lr']
 
-def train(loader, net, criterion, optimizer, device, debug_steps=100, epoch=-1):
+def normalize_images(images, image_mean, image_std):
+    # loaders deliver uint8 images, normalization runs on the device
+    return (images.float() - image_mean) / image_std
+
+class CUDAGraphTrainStep:
+    def __init__(self, net, criterion, optimizer, image_mean, image_std, warmup_steps=3):
+        """Replay a whole training step (forward, loss, backward, SGD step) as one CUDA graph.
+
+        Batches are copied into static input buffers before each replay, so every
+        batch must have the same shape. Learning rates are baked into the captured
+        optimizer kernels, so the step is captured again whenever they change.
+        Before the first capture, warmup_steps steps are run on the first batch with
+        the learning rates at 0; the BatchNorm statistics and momentum buffers they
+        touch are restored afterwards, so they do not update the model.
+        """
+        self.net = net
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.image_mean = image_mean
+        self.image_std = image_std
+        self.warmup_steps = warmup_steps
+        self.graph = None
+        self.lrs = None
+        self.static_images = None
+        self.static_boxes = None
+        self.static_labels = None
+        self.static_losses = None
+
+    def _step(self):
+        images = normalize_images(self.static_images, self.image_mean, self.image_std)
+        images = images.contiguous(memory_format=torch.channels_last)
+        confidence, locations = self.net(images)
+        regression_loss, classification_loss = self.criterion(confidence, locations, self.static_labels, self.static_boxes)
+        loss = regression_loss + classification_loss
+        loss.backward()
+        self.optimizer.step()
+        return torch.stack([loss, regression_loss, classification_loss]).detach()
+
+    def _warmup(self):
+        # warm up on a side stream so cuDNN autotuning and the allocation of
+        # the optimizer state happen before capture
+        param_groups = self.optimizer.param_groups
+        lrs = [param_group['lr'] for param_group in param_groups]
+        net_buffers = [buffer.clone() for buffer in self.net.buffers()]
+        momentum_buffers = {p: state['momentum_buffer'].clone() for p, state in self.optimizer.state.items()
+                            if state.get('momentum_buffer') is not None}
+        for param_group in param_groups:
+            param_group['lr'] = 0.0
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_steps):
+                self.optimizer.zero_grad(set_to_none=True)
+                self._step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # undo everything the warm-up steps changed besides allocating state
+        for param_group, lr in zip(param_groups, lrs):
+            param_group['lr'] = lr
+        with torch.no_grad():
+            for buffer, saved in zip(self.net.buffers(), net_buffers):
+                buffer.copy_(saved)
+            for p, state in self.optimizer.state.items():
+                buffer = state.get('momentum_buffer')
+                if buffer is None:
+                    continue
+                if p in momentum_buffers:
+                    buffer.copy_(momentum_buffers[p])
+                else:
+                    # without dampening a zero buffer behaves like a fresh one
+                    buffer.zero_()
+
+    def _capture(self):
+        if self.graph is None:
+            self._warmup()
+        self.graph = torch.cuda.CUDAGraph()
+        # gradients are allocated from the graph's private pool and overwritten on replay
+        self.optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(self.graph):
+            self.static_losses = self._step()
+
+    def __call__(self, images, boxes, labels):
+        if self.static_images is None:
+            self.static_images = torch.empty_like(images)
+            self.static_boxes = torch.empty_like(boxes)
+            self.static_labels = torch.empty_like(labels)
+        self.static_images.copy_(images, non_blocking=True)
+        self.static_boxes.copy_(boxes, non_blocking=True)
+        self.static_labels.copy_(labels, non_blocking=True)
+        lrs = [param_group['lr'] for param_group in self.optimizer.param_groups]
+        if self.graph is None or lrs != self.lrs:
+            self._capture()
+            self.lrs = lrs
+        self.graph.replay()
+        return self.static_losses
+
+def train(loader, net, criterion, optimizer, scaler, device, image_mean, image_std, debug_steps=100, epoch=-1,
+          graph_step=None):
     net.train(True)
-    running_loss = 0.0
-    running_regression_loss = 0.0
-    running_classification_loss = 0.0
-    epoch_loss = 0.0
-    epoch_regression_loss = 0.0
-    epoch_classification_loss = 0.0
+    # (loss, regression loss, classification loss) are accumulated on the device
+    # so the loop only syncs, once, every debug_steps
+    running_losses = torch.zeros(3, device=device)
+    epoch_losses = torch.zeros(3, device=device)
     epoch_steps = 0
 #    print(f"Batch size: {args.batch_size}, DataLoader length: {len(loader)}, Dataset length: {len(train_dataset)}")
     for i, data in enumerate(loader):
         images, boxes, labels = data
-        images = images.to(device)
-        boxes = boxes.to(device)
-        labels = labels.to(device)
+        images = images.to(device, non_blocking=True)
+        boxes = boxes.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
 
-        optimizer.zero_grad()
-        confidence, locations = net(images)
-        regression_loss, classification_loss = criterion(confidence, locations, labels, boxes)  # TODO CHANGE BOXES
-        loss = regression_loss + classification_loss
-        loss.backward()
-        optimizer.step()
-
-        running_loss += loss.item()
-        running_regression_loss += regression_loss.item()
-        running_classification_loss += classification_loss.item()
-        epoch_loss += loss.item()
-        epoch_regression_loss += regression_loss.item()
-        epoch_classification_loss += classification_loss.item()
+        if graph_step is not None:
+            losses = graph_step(images, boxes, labels)
+        else:
+            images = normalize_images(images, image_mean, image_std)
+            images = images.contiguous(memory_format=torch.channels_last)
+
+            optimizer.zero_grad(set_to_none=True)
+            with torch.cuda.amp.autocast(enabled=USE_AMP):
+                confidence, locations = net(images)
+                regression_loss, classification_loss = criterion(confidence, locations, labels, boxes)  # TODO CHANGE BOXES
+                loss = regression_loss + classification_loss
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+            losses = torch.stack([loss, regression_loss, classification_loss]).detach()
+        running_losses += losses
+        epoch_losses += losses
         epoch_steps += 1
         if i and i % debug_steps == 0:
-            avg_loss = running_loss / debug_steps
-            avg_reg_loss = running_regression_loss / debug_steps
-            avg_clf_loss = running_classification_loss / debug_steps
+            avg_loss, avg_reg_loss, avg_clf_loss = (running_losses / debug_steps).tolist()
             logging.info(
-                f"Epoch: {epoch}, Step: {i}/{len(loader)}, " +
-                f"Avg Loss: {avg_loss:.4f}, " +
-                f"Avg Regression Loss {avg_reg_loss:.4f}, " +
-                f"Avg Classification Loss: {avg_clf_loss:.4f}"
+                "Epoch: %s, Step: %d/%d, Avg Loss: %.4f, "
+                "Avg Regression Loss %.4f, Avg Classification Loss: %.4f",
+                epoch, i, len(loader), avg_loss, avg_reg_loss, avg_clf_loss
             )
-            running_loss = 0.0
-            running_regression_loss = 0.0
-            running_classification_loss = 0.0
+            running_losses.zero_()
     # epoch_loss = epoch_loss / epoch_steps
     # epoch_regression_loss = epoch_regression_loss / epoch_steps
     # epoch_classification_loss = epoch_classification_loss / epoch_steps
-    epoch_loss = epoch_loss / len(loader)
-    epoch_regression_loss = epoch_regression_loss / len(loader)
-    epoch_classification_loss = epoch_classification_loss /len(loader)
+    epoch_loss, epoch_regression_loss, epoch_classification_loss = (epoch_losses / len(loader)).tolist()
     logging.info(
 #        f"Epoch: {epoch}, Total Steps: {epoch_steps}, Loader Size: {len(loader)}, "+
         f"Epoch: {epoch}, Training Loss: {epoch_loss:.4f}, " +
@@ -177,31 +322,35 @@ def train(loader, net, criterion, optimizer, device, debug_steps=100, epoch=-1):
     )
     return epoch_loss, epoch_regression_loss, epoch_classification_loss
 
-def test(loader, net, criterion, device):
+def test(loader, net, criterion, device, image_mean, image_std):
     net.eval()
-    running_loss = 0.0
-    running_regression_loss = 0.0
-    running_classification_loss = 0.0
+    running_losses = torch.zeros(3, device=device)
     num = 0
     for _, data in enumerate(loader):
         images, boxes, labels = data
-        images = images.to(device)
-        boxes = boxes.to(device)
-        labels = labels.to(device)
+        images = images.to(device, non_blocking=True)
+        boxes = boxes.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        images = normalize_images(images, image_mean, image_std)
+        images = images.contiguous(memory_format=torch.channels_last)
         num += 1
 
-        with torch.no_grad():
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=USE_AMP):
             confidence, locations = net(images)
             regression_loss, classification_loss = criterion(confidence, locations, labels, boxes)
             loss = regression_loss + classification_loss
 
-        running_loss += loss.item()
-        running_regression_loss += regression_loss.item()
-        running_classification_loss += classification_loss.item()
-    return running_loss / num, running_regression_loss / num, running_classification_loss / num
+        running_losses += torch.stack([loss, regression_loss, classification_loss])
+    running_loss, running_regression_loss, running_classification_loss = (running_losses / num).tolist()
+    return running_loss, running_regression_loss, running_classification_loss
 
 
 if __name__ == '__main__':
+    # only the main process logs, spawned loader workers re-import this script
+    start_log_listener()
+    if DEVICE.type == 'cuda':
+        logging.info("Using CUDA...")
+
     timer = Timer()
 
     logging.info(args)
@@ -217,9 +366,10 @@ if __name__ == '__main__':
     fieldnames = ['epoch', 'learning_rate', 'training_loss', 'training_regression_loss', 'training_classification_loss', 'validation_loss', 'validation_regression_loss', 'validation_classification_loss']
     start_time = dt.utcnow().strftime('%Y-%m-%d_%H%M.%S')
     report_path = os.path.join(args.checkpoint_folder, f"{start_time}_loss.report.csv")
-    with open(report_path, 'a') as report_file:
-        writer = csv.DictWriter(report_file, fieldnames=fieldnames)
-        writer.writeheader()
+    # kept open (line buffered) for the whole session, one row per validation epoch
+    report_file = open(report_path, 'a', buffering=1, newline='')
+    writer = csv.DictWriter(report_file, fieldnames=fieldnames)
+    writer.writeheader()
             
     # select the network architecture and config     
     if args.net == 'vgg16-ssd':
@@ -242,12 +392,38 @@ if __name__ == '__main__':
         parser.print_help(sys.stderr)
         sys.exit(1)
         
+    # freeze the priors in shared CPU memory; the loader workers match against a
+    # numpy view of them and only MultiboxLoss gets a copy on the device
+    config.priors = config.priors.cpu().contiguous().share_memory_()
+
     # create data transforms for train/test/val
-    train_transform = TrainAugmentation(config.image_size, config.image_mean, config.image_std)
-    target_transform = MatchPrior(config.priors, config.center_variance,
+    # (images stay uint8 on the CPU side and are normalized on the device)
+    train_transform = TrainAugmentation(config.image_size, config.image_mean, config.image_std,
+                                        normalize=False)
+    target_transform = MatchPrior(config.priors.numpy(), config.center_variance,
                                   config.size_variance, 0.5)
 
-    test_transform = TestTransform(config.image_size, config.image_mean, config.image_std)
+    test_transform = TestTransform(config.image_size, config.image_mean, config.image_std,
+                                   normalize=False)
+    image_mean = torch.as_tensor(config.image_mean, dtype=torch.float32, device=DEVICE).reshape(1, -1, 1, 1)
+    image_std = torch.as_tensor(config.image_std, dtype=torch.float32, device=DEVICE).reshape(1, -1, 1, 1)
+
+    # optionally move samples to the GPU from within the loader workers,
+    # which requires spawned workers since CUDA cannot be used after fork
+    worker_device = None
+    loader_kwargs = {'pin_memory': DEVICE.type == 'cuda'}
+    if args.worker_device_copy and args.dataset_type == 'open_images' and DEVICE.type == 'cuda':
+        logging.info("Copying samples to the GPU inside the dataloader workers.")
+        worker_device = DEVICE
+        loader_kwargs = {'pin_memory': False, 'collate_fn': device_collate}
+        if args.num_workers > 0:
+            loader_kwargs['multiprocessing_context'] = 'spawn'
+
+    # keep workers alive across epochs and prefetch deeper to hide decode latency
+    if args.num_workers > 0:
+        loader_kwargs['worker_init_fn'] = init_worker_logging
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = 4
 
     # load datasets (could be multiple)
     logging.info("Prepare training datasets.")
@@ -262,7 +438,9 @@ if __name__ == '__main__':
         elif args.dataset_type == 'open_images':
             dataset = OpenImagesDataset(dataset_path,
                  transform=train_transform, target_transform=target_transform,
-                 dataset_type="train", balance_data=args.balance_data)
+                 dataset_type="train", balance_data=args.balance_data,
+                 device=worker_device, image_cache=args.image_cache,
+                 preload_ram=args.preload_ram)
             label_file = os.path.join(args.checkpoint_folder, "labels.txt")
             store_labels(label_file, dataset.class_names)
             logging.info(dataset)
@@ -276,9 +454,17 @@ if __name__ == '__main__':
     logging.info(f"Stored labels into file {label_file}.")
     train_dataset = ConcatDataset(datasets)
     logging.info("Train dataset size: {}".format(len(train_dataset)))
+    # keep every batch the same shape, unless that would leave no batch at all
+    drop_last = len(train_dataset) >= args.batch_size
+    if not drop_last:
+        logging.warning(f"Train dataset is smaller than the batch size ({args.batch_size}), "
+                        "training on a single partial batch.")
     train_loader = DataLoader(train_dataset, args.batch_size,
                               num_workers=args.num_workers,
-                              shuffle=True)
+                              shuffle=True, drop_last=drop_last, **loader_kwargs)
+    if DEVICE.type == 'cuda':
+        # overlap the copy of the next batch with the current step
+        train_loader = CUDAPrefetcher(train_loader, DEVICE)
                            
     # create validation dataset                           
     logging.info("Prepare Validation datasets.")
@@ -288,13 +474,16 @@ if __name__ == '__main__':
     elif args.dataset_type == 'open_images':
         val_dataset = OpenImagesDataset(dataset_path,
                                         transform=test_transform, target_transform=target_transform,
-                                        dataset_type="test")
+                                        dataset_type="test", device=worker_device,
+                                        image_cache=args.image_cache, preload_ram=args.preload_ram)
         logging.info(val_dataset)
     logging.info("Validation dataset size: {}".format(len(val_dataset)))
 
     val_loader = DataLoader(val_dataset, args.batch_size,
                             num_workers=args.num_workers,
-                            shuffle=False)
+                            shuffle=False, **loader_kwargs)
+    if DEVICE.type == 'cuda':
+        val_loader = CUDAPrefetcher(val_loader, DEVICE)
                             
     # create the network
     logging.info("Build network.")
@@ -345,7 +534,9 @@ if __name__ == '__main__':
     timer.start("Load Model")
     if args.resume:
         logging.info(f"Resume from the model {args.resume}")
-        net.load(args.resume)
+        # deserialize the checkpoint once, it also holds the optimizer state and epoch
+        checkpoint = torch.load(args.resume, map_location='cpu')
+        net.load_state_dict(checkpoint['model_state_dict'])
     elif args.base_net:
         logging.info(f"Init from base net {args.base_net}")
         net.init_from_base_net(args.base_net)
@@ -354,17 +545,38 @@ if __name__ == '__main__':
         net.init_from_pretrained_ssd(args.pretrained_ssd)
     logging.info(f'Took {timer.end("Load Model"):.2f} seconds to load the model.')
 
-    # move the model to GPU
+    # move the model to GPU, using the NHWC layout preferred by cuDNN convolutions
     net.to(DEVICE)
+    net = net.to(memory_format=torch.channels_last)
+
+    # compile the training forward pass only. `net` itself is kept for checkpointing
+    # and validation, where eval mode and the ragged last batch would force recompiles.
+    train_net = net
+    if args.compile and USE_CUDA_GRAPH:
+        logging.fatal("--compile and --cuda-graph cannot be used together.")
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    if args.compile:
+        logging.info("Compiling the network with torch.compile.")
+        train_net = torch.compile(net, mode='reduce-overhead')
 
     # define loss function and optimizer
-    criterion = MultiboxLoss(config.priors, iou_threshold=0.5, neg_pos_ratio=3,
+    criterion = MultiboxLoss(config.priors.to(DEVICE), iou_threshold=0.5, neg_pos_ratio=3,
                              center_variance=0.1, size_variance=0.2, device=DEVICE)
     optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum,
                                 weight_decay=args.weight_decay)
+    scaler = torch.cuda.amp.GradScaler(enabled=USE_AMP)
+    graph_step = None
+    if USE_CUDA_GRAPH:
+        logging.info("Capturing the training step in a CUDA graph.")
+        graph_step = CUDAGraphTrainStep(net, criterion, optimizer, image_mean, image_std)
     if args.resume:
-        optimizer.load_state_dict(torch.load(args.resume)['optimizer_state_dict'])
-        r_epoch = torch.load(args.resume)['training_epoch']
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        r_epoch = checkpoint['training_epoch']
+        # a disabled GradScaler saves an empty state, which cannot be loaded
+        if checkpoint.get('scaler_state_dict'):
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        del checkpoint
         print(f"Resuming from previous epoch: {r_epoch}")
         last_epoch = r_epoch
         # ckpt_f = args.resume.split('/')[-1]
@@ -433,18 +645,17 @@ if __name__ == '__main__':
     for epoch in range(last_epoch + 1, args.num_epochs + r_epoch + 1):
         val_loss = 0
         epoch_loss, epoch_regression_loss, epoch_classification_loss = train(
-            train_loader, net, criterion, optimizer,
-            device=DEVICE, debug_steps=args.debug_steps, epoch=epoch)
+            train_loader, train_net, criterion, optimizer, scaler,
+            device=DEVICE, image_mean=image_mean, image_std=image_std, debug_steps=args.debug_steps, epoch=epoch,
+            graph_step=graph_step)
         
         if epoch % args.validation_epochs == 0 or epoch == args.num_epochs - 1:
-            val_loss, val_regression_loss, val_classification_loss = test(val_loader, net, criterion, DEVICE)
-            with open(report_path, 'a') as report_file:
-                writer = csv.DictWriter(report_file, fieldnames=fieldnames)
-                writer.writerow({'epoch':epoch, 'learning_rate':get_current_lr(optimizer), 
-                'training_loss':epoch_loss, 'training_regression_loss':epoch_regression_loss,
-                "training_classification_loss":epoch_classification_loss,
-                'validation_loss':val_loss, 'validation_regression_loss':val_regression_loss, 
-                'validation_classification_loss':val_classification_loss})
+            val_loss, val_regression_loss, val_classification_loss = test(val_loader, net, criterion, DEVICE, image_mean, image_std)
+            writer.writerow({'epoch':epoch, 'learning_rate':get_current_lr(optimizer), 
+            'training_loss':epoch_loss, 'training_regression_loss':epoch_regression_loss,
+            "training_classification_loss":epoch_classification_loss,
+            'validation_loss':val_loss, 'validation_regression_loss':val_regression_loss, 
+            'validation_classification_loss':val_classification_loss})
             logging.info(
                 f"Epoch: {epoch}, " +
                 f"Validation Loss: {val_loss:.4f}, " +
@@ -455,9 +666,10 @@ if __name__ == '__main__':
 #            opt_path = os.path.join(args.checkpoint_folder, f"{start_time}_{args.net}-Epoch-{epoch}-LR-{str(get_current_lr(optimizer))}.opt.pth")
         if epoch % args.checkpoint_epochs == 0 or epoch == args.num_epochs - 1:
             # net.save(model_path, optimizer, opt_path)
-            net.save(model_path, optimizer, epoch)
+            net.save(model_path, optimizer, epoch, scaler)
             logging.info(f"Saved model {model_path}")
 #            logging.info(f"Saved optimizer {opt_path}")
         scheduler.step(val_loss) # TODO test the use of this parameter for failure in earlier schedulers
 
+    report_file.close()
     logging.info("Task done, exiting program.")
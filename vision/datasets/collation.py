@@ -28,4 +28,10 @@ def object_detection_collate(batch):
             gt_labels.append(labels)
         else:
             raise TypeError(f"Labels should be tensor or np.ndarray, but got {label_type}.")
-    return torch.stack(images), gt_boxes, gt_labels
\ No newline at end of file
+    return torch.stack(images), gt_boxes, gt_labels
+
+
+def device_collate(batch):
+    """Stack samples that were already moved to the target device by the dataset."""
+    images, boxes, labels = zip(*batch)
+    return torch.stack(images), torch.stack(boxes), torch.stack(labels)
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 import pathlib
 import cv2
 import pandas as pd
@@ -6,41 +7,87 @@ import copy
 import os
 import logging
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
+
+# created lazily so each dataloader worker process opens its own decoder
+_turbo_jpeg = None
+_turbo_jpeg_failed = False
+
+
+def _get_turbo_jpeg():
+    global _turbo_jpeg, _turbo_jpeg_failed
+    if _turbo_jpeg is None and TurboJPEG is not None and not _turbo_jpeg_failed:
+        try:
+            _turbo_jpeg = TurboJPEG()
+        except (OSError, RuntimeError) as e:
+            # the python package imports fine without the native libturbojpeg
+            logging.warning(f'libjpeg-turbo unavailable, decoding with cv2: {e}')
+            _turbo_jpeg_failed = True
+    return _turbo_jpeg
+
+
 class OpenImagesDataset:
 
     def __init__(self, root,
                  transform=None, target_transform=None,
-                 dataset_type="train", balance_data=False):
+                 dataset_type="train", balance_data=False, device=None,
+                 image_cache=False, image_cache_size=340, preload_ram=False):
         self.root = pathlib.Path(root)
         self.transform = transform
         self.target_transform = target_transform
         self.dataset_type = dataset_type.lower()
+        # when set, samples are copied to this device inside the loader worker
+        self.device = device
+
+        self._read_data()
+
+        # optional pre-decoded uint8 image archive, memory mapped on first use
+        self.image_cache_size = image_cache_size
+        self.image_cache_file = None
+        self._image_cache = None
+        self._image_cache_index = None
+        if image_cache:
+            self._open_image_cache()
 
-        self.data, self.class_names, self.class_dict = self._read_data()
         self.balance_data = balance_data
         self.min_image_num = -1
         if self.balance_data:
-            self.data = self._balance_data()
-        self.ids = [info['image_id'] for info in self.data]
+            self._select(self._balance_data())
+        self.ids = self._image_ids
+
+        # optionally decode every image once into a shared memory tensor that
+        # forked loader workers read without copying, if it fits in memory
+        self._preloaded = None
+        self._preloaded_index = None
+        if preload_ram:
+            self._preload_images()
 
         self.class_stat = None
 
     def _getitem(self, index):
-        image_info = self.data[index]
-        image = self._read_image(image_info['image_id'])
+        start, end = self._offsets[index], self._offsets[index + 1]
+        image_id = self._image_ids[index]
+        image = self._read_image(image_id)
         # duplicate boxes to prevent corruption of dataset
-        boxes = copy.copy(image_info['boxes'])
+        boxes = copy.copy(self._boxes[start:end])
         boxes[:, 0] *= image.shape[1]
         boxes[:, 1] *= image.shape[0]
         boxes[:, 2] *= image.shape[1]
         boxes[:, 3] *= image.shape[0]
         # duplicate labels to prevent corruption of dataset
-        labels = copy.copy(image_info['labels'])
+        labels = copy.copy(self._labels[start:end])
         if self.transform:
             image, boxes, labels = self.transform(image, boxes, labels)
         if self.target_transform:
             boxes, labels = self.target_transform(boxes, labels)
-        return image_info['image_id'], image, boxes, labels
+        if self.device is not None:
+            image = image.to(self.device, non_blocking=True)
+            boxes = boxes.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+        return image_id, image, boxes, labels
 
     def __getitem__(self, index):
         _, image, boxes, labels = self._getitem(index)
@@ -53,8 +100,7 @@ class OpenImagesDataset:
         return image_id, (boxes, labels, is_difficult)
 
     def get_image(self, index):
-        image_info = self.data[index]
-        image = self._read_image(image_info['image_id'])
+        image = self._read_image(self._image_ids[index])
         if self.transform:
             image, _ = self.transform(image)
         return image
@@ -66,44 +112,142 @@ class OpenImagesDataset:
         logging.info(f'annotations loaded from:  {annotation_file}')
         class_names = ['BACKGROUND'] + sorted(list(annotations['ClassName'].unique()))
         class_dict = {class_name: i for i, class_name in enumerate(class_names)}
-        data = []
+        # make labels 64 bits to satisfy the cross_entropy function
+        annotations["_lbl"] = annotations["ClassName"].map(class_dict).astype(np.int64)
+        # annotations are stored as flat arrays, the boxes and labels of
+        # image i being the rows between _offsets[i] and _offsets[i + 1]
+        image_ids = []
+        box_arrays = []
+        label_arrays = []
         for image_id, group in annotations.groupby("ImageID"):
             img_path = os.path.join(self.root, self.dataset_type, image_id + '.jpg')
             if os.path.isfile(img_path) is False:
                  logging.error(f'missing ImageID {image_id}.jpg - dropping from annotations')
                  continue
-            boxes = group.loc[:, ["XMin", "YMin", "XMax", "YMax"]].values.astype(np.float32)
-            # make labels 64 bits to satisfy the cross_entropy function
-            labels = np.array([class_dict[name] for name in group["ClassName"]], dtype='int64')
-            #print('found image {:s}  ({:d})'.format(img_path, len(data)))
-            data.append({
-                'image_id': image_id,
-                'boxes': boxes,
-                'labels': labels
-            })
-        print('num images:  {:d}'.format(len(data)))
-        return data, class_names, class_dict
+            image_ids.append(image_id)
+            box_arrays.append(group[["XMin", "YMin", "XMax", "YMax"]].to_numpy(dtype=np.float32, copy=False))
+            label_arrays.append(group["_lbl"].to_numpy())
+        print('num images:  {:d}'.format(len(image_ids)))
+        self.class_names = class_names
+        self.class_dict = class_dict
+        self._image_ids = np.asarray(image_ids)
+        self._boxes = np.concatenate(box_arrays) if box_arrays else np.zeros((0, 4), dtype=np.float32)
+        self._labels = np.concatenate(label_arrays) if label_arrays else np.zeros(0, dtype=np.int64)
+        self._offsets = np.cumsum([0] + [len(labels) for labels in label_arrays])
+
+    def _select(self, indexes):
+        """Keep only the images at the given indexes."""
+        indexes = np.asarray(indexes, dtype=np.int64)
+        starts = self._offsets[indexes]
+        lens = self._offsets[indexes + 1] - starts
+        offsets = np.concatenate([[0], np.cumsum(lens)])
+        # row r of the selection comes from starts[i] + (r - offsets[i]) for its image i
+        rows = np.repeat(starts - offsets[:-1], lens) + np.arange(offsets[-1])
+        self._image_ids = self._image_ids[indexes]
+        self._boxes = self._boxes[rows]
+        self._labels = self._labels[rows]
+        self._offsets = offsets
 
     def __len__(self):
-        return len(self.data)
+        return len(self._image_ids)
 
     def __repr__(self):
         if self.class_stat is None:
-            self.class_stat = {name: 0 for name in self.class_names[1:]}
-            for example in self.data:
-                for class_index in example['labels']:
-                    class_name = self.class_names[class_index]
-                    self.class_stat[class_name] += 1
+            counts = np.bincount(self._labels, minlength=len(self.class_names))
+            self.class_stat = {name: int(counts[i]) for i, name in enumerate(self.class_names[1:], start=1)}
         content = ["Dataset Summary:"
-                   f"Number of Images: {len(self.data)}",
+                   f"Number of Images: {len(self)}",
                    f"Minimum Number of Images for a Class: {self.min_image_num}",
                    "Label Distribution:"]
         for class_name, num in self.class_stat.items():
             content.append(f"\t{class_name}: {num}")
         return "\n".join(content)
 
+    def __getstate__(self):
+        # never pickle the memory map itself into loader workers
+        state = self.__dict__.copy()
+        state['_image_cache'] = None
+        return state
+
+    def _open_image_cache(self):
+        size = self.image_cache_size
+        self.image_cache_file = self.root / f"sub-{self.dataset_type}-images-{size}.npy"
+        ids_file = self.root / f"sub-{self.dataset_type}-images-{size}.ids.npz"
+        if not self._image_cache_is_valid(self.image_cache_file, ids_file):
+            self._build_image_cache(self.image_cache_file, ids_file)
+        image_ids = np.load(ids_file)['image_ids']
+        self._image_cache_index = {image_id: i for i, image_id in enumerate(image_ids)}
+
+    def _image_cache_is_valid(self, cache_file, ids_file):
+        if not cache_file.is_file() or not ids_file.is_file():
+            return False
+        size = self.image_cache_size
+        image_ids = np.load(ids_file)['image_ids']
+        shape = np.load(cache_file, mmap_mode='r').shape
+        if shape != (len(image_ids), size, size, 3):
+            logging.info(f'image cache {cache_file} has shape {shape}, rebuilding')
+            return False
+        # the annotations may have changed since the cache was built
+        if not np.isin(self._image_ids, image_ids).all():
+            logging.info(f'image cache {cache_file} is missing images, rebuilding')
+            return False
+        return True
+
+    def _build_image_cache(self, cache_file, ids_file):
+        size = self.image_cache_size
+        logging.info(f'building image cache: {cache_file}')
+        # images are squashed to a square like the final Resize transform,
+        # so the normalized boxes from the annotations stay valid
+        images = np.lib.format.open_memmap(str(cache_file), mode='w+', dtype=np.uint8,
+                                           shape=(len(self), size, size, 3))
+        for i, image_id in enumerate(self._image_ids):
+            image = self._decode_image(image_id)
+            images[i] = cv2.resize(image, (size, size))
+        images.flush()
+        del images
+        np.savez(ids_file, image_ids=self._image_ids)
+        logging.info(f'image cache built with {len(self)} images')
+
+    def _preload_images(self):
+        size = self.image_cache_size
+        required = len(self) * size * size * 3
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        if required > available:
+            logging.warning(f'not preloading {len(self)} images: {required / 2**30:.1f} GiB needed, '
+                            f'{available / 2**30:.1f} GiB of memory available')
+            return
+        logging.info(f'preloading {len(self)} images into shared memory')
+        preloaded = torch.empty((len(self), size, size, 3), dtype=torch.uint8).share_memory_()
+        for i, image_id in enumerate(self._image_ids):
+            image = self._read_image(image_id)
+            if image.shape[:2] != (size, size):
+                # squashed like the image cache, normalized boxes stay valid
+                image = cv2.resize(image, (size, size))
+            preloaded[i].numpy()[...] = image
+        self._preloaded = preloaded
+        self._preloaded_index = {image_id: i for i, image_id in enumerate(self._image_ids)}
+
     def _read_image(self, image_id):
+        if self._preloaded_index is not None:
+            return self._preloaded[self._preloaded_index[image_id]].numpy()
+        if self._image_cache_index is not None:
+            if self._image_cache is None:
+                self._image_cache = np.load(self.image_cache_file, mmap_mode='r')
+            return self._image_cache[self._image_cache_index[image_id]]
+        return self._decode_image(image_id)
+
+    def _decode_image(self, image_id):
         image_file = self.root / self.dataset_type / f"{image_id}.jpg"
+        decoder = _get_turbo_jpeg()
+        if decoder is not None:
+            # libjpeg-turbo decodes straight into RGB, no colour conversion pass needed
+            with open(image_file, 'rb') as f:
+                buf = f.read()
+            try:
+                return decoder.decode(buf, pixel_format=TJPF_RGB)
+            except (OSError, RuntimeError):
+                # not really a JPEG, let cv2 handle whatever format it is
+                pass
         image = cv2.imread(str(image_file))
         if image.shape[2] == 1:
             image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
@@ -113,21 +257,12 @@ class OpenImagesDataset:
 
     def _balance_data(self):
         logging.info('balancing data')
-        label_image_indexes = [set() for _ in range(len(self.class_names))]
-        for i, image in enumerate(self.data):
-            for label_id in image['labels']:
-                label_image_indexes[label_id].add(i)
-        label_stat = [len(s) for s in label_image_indexes]
-        self.min_image_num = min(label_stat[1:])
-        sample_image_indexes = set()
-        for image_indexes in label_image_indexes[1:]:
-            image_indexes = np.array(list(image_indexes))
-            sub = np.random.permutation(image_indexes)[:self.min_image_num]
-            sample_image_indexes.update(sub)
-        sample_data = [self.data[i] for i in sample_image_indexes]
-        return sample_data
-
-
-
-
-
+        image_indexes = np.repeat(np.arange(len(self)), np.diff(self._offsets))
+        df = pd.DataFrame({'idx': image_indexes, 'label': self._labels})
+        per_label_idx = df.groupby('label')['idx'].unique()
+        per_label_idx = [per_label_idx.get(label, np.zeros(0, dtype=np.int64))
+                         for label in range(1, len(self.class_names))]
+        self.min_image_num = min(len(indexes) for indexes in per_label_idx)
+        samples = [np.random.choice(indexes, size=self.min_image_num, replace=False)
+                   for indexes in per_label_idx]
+        return np.unique(np.concatenate(samples)).astype(np.int64)
@@ -0,0 +1,42 @@
+import torch
+
+
+class CUDAPrefetcher:
+    """Wrap a DataLoader so the next batch is copied to the GPU on a side stream.
+
+    While the current step runs on the default stream, the host-to-device copy
+    of the following batch is issued on a separate stream. The default stream
+    only waits on an event recorded after that copy, so the host never blocks.
+    The loader should use pin_memory=True for the copies to be asynchronous.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None, None
+        with torch.cuda.stream(self.stream):
+            batch = [t.to(self.device, non_blocking=True) for t in batch]
+            event = self.stream.record_event()
+        return batch, event
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch, event = self._preload(it)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for t in batch:
+                # the tensors were allocated on the side stream but are used on this one
+                t.record_stream(current_stream)
+            next_batch, next_event = self._preload(it)
+            yield batch
+            batch, event = next_batch, next_event
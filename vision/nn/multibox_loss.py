@@ -37,11 +37,12 @@ class MultiboxLoss(nn.Module):
             loss = -F.log_softmax(confidence, dim=2)[:, :, 0]
             mask = box_utils.hard_negative_mining(loss, labels, self.neg_pos_ratio)
 
-        confidence = confidence[mask, :]
-        classification_loss = F.cross_entropy(confidence.reshape(-1, num_classes), labels[mask], size_average=False)
+        # reduce with masks instead of boolean indexing so that every tensor keeps
+        # a static shape and no host sync is needed (allows CUDA graph capture)
+        classification_loss = F.cross_entropy(confidence.reshape(-1, num_classes), labels.reshape(-1), reduction='none')
+        classification_loss = classification_loss.masked_fill(~mask.reshape(-1), 0).sum()
         pos_mask = labels > 0
-        predicted_locations = predicted_locations[pos_mask, :].reshape(-1, 4)
-        gt_locations = gt_locations[pos_mask, :].reshape(-1, 4)
-        smooth_l1_loss = F.smooth_l1_loss(predicted_locations, gt_locations, size_average=False)
-        num_pos = gt_locations.size(0)
+        smooth_l1_loss = F.smooth_l1_loss(predicted_locations, gt_locations, reduction='none').sum(dim=2)
+        smooth_l1_loss = smooth_l1_loss.masked_fill(~pos_mask, 0).sum()
+        num_pos = pos_mask.sum()
         return smooth_l1_loss/num_pos, classification_loss/num_pos
@@ -1,12 +1,20 @@
 from ..transforms.transforms import *
 
 
+def _to_tensor(mean, std, normalize):
+    if normalize:
+        return [SubtractMeans(mean), DivideStd(std), ToTensor()]
+    return [ToUint8Tensor()]
+
+
 class TrainAugmentation:
-    def __init__(self, size, mean=0, std=1.0):
+    def __init__(self, size, mean=0, std=1.0, normalize=True):
         """
         Args:
             size: the size the of final image.
             mean: mean pixel value per channel.
+            normalize: if False, skip mean/std normalization and output a uint8 tensor
+                so that normalization can be done on the device.
         """
         self.mean = mean
         self.size = size
@@ -18,10 +26,7 @@ class TrainAugmentation:
             RandomMirror(),
             ToPercentCoords(),
             Resize(self.size),
-            SubtractMeans(self.mean),
-            lambda img, boxes=None, labels=None: (img / std, boxes, labels),
-            ToTensor(),
-        ])
+        ] + _to_tensor(mean, std, normalize))
 
     def __call__(self, img, boxes, labels):
         """
@@ -35,14 +40,11 @@ class TrainAugmentation:
 
 
 class TestTransform:
-    def __init__(self, size, mean=0.0, std=1.0):
+    def __init__(self, size, mean=0.0, std=1.0, normalize=True):
         self.transform = Compose([
             ToPercentCoords(),
             Resize(size),
-            SubtractMeans(mean),
-            lambda img, boxes=None, labels=None: (img / std, boxes, labels),
-            ToTensor(),
-        ])
+        ] + _to_tensor(mean, std, normalize))
 
     def __call__(self, image, boxes, labels):
         return self.transform(image, boxes, labels)
@@ -53,7 +55,7 @@ class PredictionTransform:
         self.transform = Compose([
             Resize(size),
             SubtractMeans(mean),
-            lambda img, boxes=None, labels=None: (img / std, boxes, labels),
+            DivideStd(std),
             ToTensor()
         ])
 
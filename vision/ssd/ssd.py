@@ -4,7 +4,7 @@ import numpy as np
 from typing import List, Tuple
 import torch.nn.functional as F
 
-from ..utils import box_utils
+from ..utils import box_utils, box_utils_numpy
 from collections import namedtuple
 GraphPath = namedtuple("GraphPath", ['s0', 'name', 's1'])  #
 
@@ -140,23 +140,32 @@ class SSD(nn.Module):
     # def save(self, model_path, optimizer, opt_path):
     #     torch.save(self.state_dict(), model_path)
     #     torch.save(optimizer.state_dict(), opt_path)
-    def save(self, model_path, optimizer, epoch):
-        torch.save({
+    def save(self, model_path, optimizer, epoch, scaler=None):
+        checkpoint = {
             'model_state_dict': self.state_dict(),
             'optimizer_state_dict': optimizer.state_dict(),
             'training_epoch': epoch
-            }, model_path)
+            }
+        if scaler is not None:
+            # AMP loss scale, so resumed runs do not restart from the initial scale
+            checkpoint['scaler_state_dict'] = scaler.state_dict()
+        torch.save(checkpoint, model_path)
 
 
 class MatchPrior(object):
     def __init__(self, center_form_priors, center_variance, size_variance, iou_threshold):
         self.center_form_priors = center_form_priors
-        self.corner_form_priors = box_utils.center_form_to_corner_form(center_form_priors)
+        # numpy priors keep the matching in plain numpy inside the loader workers
+        self.use_numpy = type(center_form_priors) is np.ndarray
+        utils = box_utils_numpy if self.use_numpy else box_utils
+        self.corner_form_priors = utils.center_form_to_corner_form(center_form_priors)
         self.center_variance = center_variance
         self.size_variance = size_variance
         self.iou_threshold = iou_threshold
 
     def __call__(self, gt_boxes, gt_labels):
+        if self.use_numpy:
+            return self._match_numpy(gt_boxes, gt_labels)
         if type(gt_boxes) is np.ndarray:
             gt_boxes = torch.from_numpy(gt_boxes)
         if type(gt_labels) is np.ndarray:
@@ -167,6 +176,17 @@ class MatchPrior(object):
         locations = box_utils.convert_boxes_to_locations(boxes, self.center_form_priors, self.center_variance, self.size_variance)
         return locations, labels
 
+    def _match_numpy(self, gt_boxes, gt_labels):
+        if type(gt_boxes) is torch.Tensor:
+            gt_boxes = gt_boxes.numpy()
+        if type(gt_labels) is torch.Tensor:
+            gt_labels = gt_labels.numpy()
+        boxes, labels = box_utils_numpy.assign_priors(gt_boxes, gt_labels,
+                                                      self.corner_form_priors, self.iou_threshold)
+        boxes = box_utils_numpy.corner_form_to_center_form(boxes)
+        locations = box_utils_numpy.convert_boxes_to_locations(boxes, self.center_form_priors, self.center_variance, self.size_variance)
+        return torch.from_numpy(locations.astype(np.float32, copy=False)), torch.from_numpy(labels)
+
 
 def _xavier_init_(m: nn.Module):
     if isinstance(m, nn.Conv2d):
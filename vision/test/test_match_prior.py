@@ -0,0 +1,42 @@
+from ..ssd.ssd import MatchPrior
+from ..ssd.config import mobilenetv1_ssd_config as config
+
+import numpy as np
+import torch
+
+
+def match_both(gt_boxes, gt_labels):
+    torch_match = MatchPrior(config.priors, config.center_variance, config.size_variance, 0.5)
+    numpy_match = MatchPrior(config.priors.numpy(), config.center_variance, config.size_variance, 0.5)
+    torch_locations, torch_labels = torch_match(gt_boxes.copy(), gt_labels.copy())
+    numpy_locations, numpy_labels = numpy_match(gt_boxes.copy(), gt_labels.copy())
+    return (torch_locations, torch_labels), (numpy_locations, numpy_labels)
+
+
+def assert_same(torch_result, numpy_result):
+    torch_locations, torch_labels = torch_result
+    numpy_locations, numpy_labels = numpy_result
+    assert type(numpy_locations) is torch.Tensor and type(numpy_labels) is torch.Tensor
+    assert numpy_locations.dtype == torch_locations.dtype
+    assert torch.equal(numpy_labels, torch_labels)
+    assert torch.allclose(numpy_locations, torch_locations, atol=1e-5)
+
+
+def test_random_boxes():
+    np.random.seed(0)
+    for num_targets in [1, 3, 10]:
+        corners = np.random.uniform(0.0, 1.0, (num_targets, 2, 2)).astype(np.float32)
+        gt_boxes = np.concatenate([corners.min(axis=1), corners.max(axis=1) + 0.01], axis=1)
+        gt_labels = np.random.randint(1, 5, num_targets).astype(np.int64)
+        assert_same(*match_both(gt_boxes, gt_labels))
+
+
+def test_targets_sharing_best_prior():
+    # identical boxes have the same best prior, the last target must get it
+    gt_boxes = np.array([[0.1, 0.1, 0.4, 0.4],
+                         [0.1, 0.1, 0.4, 0.4],
+                         [0.5, 0.5, 0.9, 0.8]], dtype=np.float32)
+    gt_labels = np.array([1, 2, 3], dtype=np.int64)
+    torch_result, numpy_result = match_both(gt_boxes, gt_labels)
+    assert_same(torch_result, numpy_result)
+    assert 2 in numpy_result[1].tolist()
@@ -0,0 +1,58 @@
+from ..nn.multibox_loss import MultiboxLoss
+
+import math
+import torch
+import torch.nn.functional as F
+
+
+def boolean_index_loss(confidence, predicted_locations, labels, gt_locations, neg_pos_ratio):
+    """The MultiboxLoss computation as it was before switching to masked reductions."""
+    num_classes = confidence.size(2)
+    with torch.no_grad():
+        loss = -F.log_softmax(confidence, dim=2)[:, :, 0]
+        pos_mask = labels > 0
+        num_pos = pos_mask.long().sum(dim=1, keepdim=True)
+        num_neg = num_pos * neg_pos_ratio
+        loss[pos_mask] = -math.inf
+        _, indexes = loss.sort(dim=1, descending=True)
+        _, orders = indexes.sort(dim=1)
+        mask = pos_mask | (orders < num_neg)
+
+    confidence = confidence[mask, :]
+    classification_loss = F.cross_entropy(confidence.reshape(-1, num_classes), labels[mask], reduction='sum')
+    pos_mask = labels > 0
+    predicted_locations = predicted_locations[pos_mask, :].reshape(-1, 4)
+    gt_locations = gt_locations[pos_mask, :].reshape(-1, 4)
+    smooth_l1_loss = F.smooth_l1_loss(predicted_locations, gt_locations, reduction='sum')
+    num_pos = gt_locations.size(0)
+    return smooth_l1_loss/num_pos, classification_loss/num_pos
+
+
+def test_matches_boolean_index_loss():
+    torch.manual_seed(0)
+    batch_size, num_priors, num_classes = 4, 100, 5
+    criterion = MultiboxLoss(torch.zeros(num_priors, 4), iou_threshold=0.5, neg_pos_ratio=3,
+                             center_variance=0.1, size_variance=0.2, device=torch.device("cpu"))
+    for _ in range(5):
+        confidence = torch.randn(batch_size, num_priors, num_classes, dtype=torch.float64)
+        locations = torch.randn(batch_size, num_priors, 4, dtype=torch.float64)
+        gt_locations = torch.randn(batch_size, num_priors, 4, dtype=torch.float64)
+        labels = torch.randint(1, num_classes, (batch_size, num_priors))
+        labels[torch.rand(batch_size, num_priors) < 0.8] = 0
+        # one image without any positive prior
+        labels[1] = 0
+
+        confidence_a = confidence.clone().requires_grad_()
+        locations_a = locations.clone().requires_grad_()
+        regression_a, classification_a = criterion(confidence_a, locations_a, labels, gt_locations)
+        (regression_a + classification_a).backward()
+
+        confidence_b = confidence.clone().requires_grad_()
+        locations_b = locations.clone().requires_grad_()
+        regression_b, classification_b = boolean_index_loss(confidence_b, locations_b, labels, gt_locations, 3)
+        (regression_b + classification_b).backward()
+
+        assert torch.allclose(regression_a, regression_b)
+        assert torch.allclose(classification_a, classification_b)
+        assert torch.allclose(confidence_a.grad, confidence_b.grad)
+        assert torch.allclose(locations_a.grad, locations_b.grad)
@@ -0,0 +1,189 @@
+from ..datasets.open_images import OpenImagesDataset
+
+import cv2
+import numpy as np
+import pytest
+
+
+# image_id -> [(class_name, x_min, y_min, x_max, y_max)], image "d" has no file on disk
+ANNOTATIONS = {
+    "a": [("Cat", 0.1, 0.2, 0.5, 0.6), ("Dog", 0.3, 0.1, 0.9, 0.8)],
+    "b": [("Cat", 0.0, 0.0, 1.0, 1.0)],
+    "c": [("Dog", 0.2, 0.2, 0.4, 0.4), ("Dog", 0.5, 0.5, 0.7, 0.9), ("Bird", 0.1, 0.3, 0.3, 0.5)],
+    "d": [("Cat", 0.1, 0.1, 0.2, 0.2)],
+}
+IMAGE_HEIGHT = 10
+IMAGE_WIDTH = 20
+
+
+def write_dataset(root, annotations, image_ids):
+    lines = ["ImageID,ClassName,XMin,YMin,XMax,YMax"]
+    for image_id, boxes in annotations.items():
+        for name, x_min, y_min, x_max, y_max in boxes:
+            lines.append(f"{image_id},{name},{x_min},{y_min},{x_max},{y_max}")
+    (root / "sub-train-annotations-bbox.csv").write_text("\n".join(lines) + "\n")
+    (root / "train").mkdir(exist_ok=True)
+    for image_id in image_ids:
+        image = np.zeros((IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.uint8)
+        cv2.imwrite(str(root / "train" / f"{image_id}.jpg"), image)
+
+
+@pytest.fixture
+def root(tmp_path):
+    write_dataset(tmp_path, ANNOTATIONS, "abc")
+    return tmp_path
+
+
+@pytest.fixture
+def build_calls(monkeypatch):
+    """Record every image cache (re)build."""
+    calls = []
+    build = OpenImagesDataset._build_image_cache
+
+    def counting_build(self, cache_file, ids_file):
+        calls.append(cache_file)
+        return build(self, cache_file, ids_file)
+
+    monkeypatch.setattr(OpenImagesDataset, '_build_image_cache', counting_build)
+    return calls
+
+
+def expected(dataset, image_id):
+    boxes = np.array([box[1:] for box in ANNOTATIONS[image_id]], dtype=np.float32)
+    labels = np.array([dataset.class_dict[box[0]] for box in ANNOTATIONS[image_id]], dtype=np.int64)
+    return boxes, labels
+
+
+def test_read_data(root):
+    dataset = OpenImagesDataset(root)
+    assert dataset.class_names == ['BACKGROUND', 'Bird', 'Cat', 'Dog']
+    # the image without a file is dropped
+    assert list(dataset.ids) == ["a", "b", "c"]
+    assert len(dataset) == 3
+
+
+def test_getitem(root):
+    dataset = OpenImagesDataset(root)
+    for index in range(len(dataset)):
+        image_id, image, boxes, labels = dataset._getitem(index)
+        expected_boxes, expected_labels = expected(dataset, image_id)
+        expected_boxes[:, [0, 2]] *= IMAGE_WIDTH
+        expected_boxes[:, [1, 3]] *= IMAGE_HEIGHT
+        assert image.shape == (IMAGE_HEIGHT, IMAGE_WIDTH, 3)
+        np.testing.assert_allclose(boxes, expected_boxes, rtol=1e-6)
+        np.testing.assert_array_equal(labels, expected_labels)
+    # scaling the boxes of a sample must not touch the stored annotations
+    _, _, boxes, _ = dataset._getitem(0)
+    np.testing.assert_allclose(dataset._boxes[:2], expected(dataset, "a")[0])
+
+
+def test_select(root):
+    dataset = OpenImagesDataset(root)
+    dataset._select(np.array([2, 0]))
+    assert list(dataset._image_ids) == ["c", "a"]
+    assert list(dataset._offsets) == [0, 3, 5]
+    for index, image_id in enumerate(dataset._image_ids):
+        start, end = dataset._offsets[index], dataset._offsets[index + 1]
+        expected_boxes, expected_labels = expected(dataset, image_id)
+        np.testing.assert_allclose(dataset._boxes[start:end], expected_boxes)
+        np.testing.assert_array_equal(dataset._labels[start:end], expected_labels)
+
+
+def test_select_empty(root):
+    dataset = OpenImagesDataset(root)
+    dataset._select(np.zeros(0, dtype=np.int64))
+    assert len(dataset) == 0
+    assert dataset._boxes.shape == (0, 4)
+    assert list(dataset._offsets) == [0]
+
+
+def test_balance_data(root):
+    np.random.seed(0)
+    dataset = OpenImagesDataset(root, balance_data=True)
+    # Bird only appears in image "c"
+    assert dataset.min_image_num == 1
+    assert "c" in dataset.ids
+    assert set(dataset._labels) == {1, 2, 3}
+    for index, image_id in enumerate(dataset.ids):
+        start, end = dataset._offsets[index], dataset._offsets[index + 1]
+        expected_boxes, expected_labels = expected(dataset, image_id)
+        np.testing.assert_allclose(dataset._boxes[start:end], expected_boxes)
+        np.testing.assert_array_equal(dataset._labels[start:end], expected_labels)
+
+
+def test_repr_counts(root):
+    dataset = OpenImagesDataset(root)
+    summary = repr(dataset)
+    assert dataset.class_stat == {'Bird': 1, 'Cat': 2, 'Dog': 3}
+    assert "\tDog: 3" in summary
+
+
+def test_image_cache_build(root, build_calls):
+    dataset = OpenImagesDataset(root, image_cache=True)
+    assert len(build_calls) == 1
+    images = np.load(root / "sub-train-images-340.npy", mmap_mode='r')
+    assert images.shape == (3, 340, 340, 3)
+    assert images.dtype == np.uint8
+    image_ids = np.load(root / "sub-train-images-340.ids.npz")['image_ids']
+    assert list(image_ids) == ["a", "b", "c"]
+    assert dataset._read_image("b").shape == (340, 340, 3)
+
+
+def test_image_cache_reused(root, build_calls):
+    OpenImagesDataset(root, image_cache=True)
+    OpenImagesDataset(root, image_cache=True)
+    assert len(build_calls) == 1
+
+
+def test_image_cache_rebuilt_for_new_images(root, build_calls):
+    OpenImagesDataset(root, image_cache=True)
+    annotations = dict(ANNOTATIONS, e=[("Bird", 0.1, 0.1, 0.6, 0.6)])
+    write_dataset(root, annotations, "e")
+    dataset = OpenImagesDataset(root, image_cache=True)
+    assert len(build_calls) == 2
+    assert np.load(root / "sub-train-images-340.npy", mmap_mode='r').shape == (4, 340, 340, 3)
+    # every image is in the rebuilt cache, no KeyError on lookup
+    for index in range(len(dataset)):
+        dataset._getitem(index)
+
+
+def test_image_cache_rebuilt_for_wrong_shape(root, build_calls):
+    OpenImagesDataset(root, image_cache=True)
+    # a cache written with another size under this name
+    np.save(root / "sub-train-images-340.npy", np.zeros((3, 100, 100, 3), dtype=np.uint8))
+    OpenImagesDataset(root, image_cache=True)
+    assert len(build_calls) == 2
+    assert np.load(root / "sub-train-images-340.npy", mmap_mode='r').shape == (3, 340, 340, 3)
+
+
+def test_image_cache_size(root, build_calls):
+    OpenImagesDataset(root, image_cache=True)
+    dataset = OpenImagesDataset(root, image_cache=True, image_cache_size=128)
+    assert len(build_calls) == 2
+    assert np.load(root / "sub-train-images-128.npy", mmap_mode='r').shape == (3, 128, 128, 3)
+    assert dataset._read_image("a").shape == (128, 128, 3)
+
+
+def test_image_cache_getitem(root):
+    dataset = OpenImagesDataset(root, image_cache=True)
+    for index in range(len(dataset)):
+        image_id, image, boxes, labels = dataset._getitem(index)
+        expected_boxes, expected_labels = expected(dataset, image_id)
+        assert image.shape == (340, 340, 3)
+        np.testing.assert_allclose(boxes, expected_boxes * 340, rtol=1e-6)
+        np.testing.assert_array_equal(labels, expected_labels)
+
+
+def test_preload_ram(root):
+    dataset = OpenImagesDataset(root, image_cache=True, preload_ram=True)
+    assert tuple(dataset._preloaded.shape) == (3, 340, 340, 3)
+    cached = np.load(root / "sub-train-images-340.npy", mmap_mode='r')
+    np.testing.assert_array_equal(dataset._read_image("c"), cached[2])
+
+
+def test_preload_ram_does_not_fit(root, monkeypatch):
+    monkeypatch.setattr("os.sysconf", lambda name: 1)
+    dataset = OpenImagesDataset(root, preload_ram=True)
+    assert dataset._preloaded is None
+    # falls back to decoding the JPEGs
+    assert dataset._read_image("a").shape == (IMAGE_HEIGHT, IMAGE_WIDTH, 3)
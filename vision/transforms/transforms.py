@@ -82,6 +82,14 @@ class SubtractMeans(object):
         return image.astype(np.float32), boxes, labels
 
 
+class DivideStd(object):
+    def __init__(self, std):
+        self.std = std
+
+    def __call__(self, image, boxes=None, labels=None):
+        return image / self.std, boxes, labels
+
+
 class ToAbsoluteCoords(object):
     def __call__(self, image, boxes=None, labels=None):
         height, width, channels = image.shape
@@ -214,6 +222,12 @@ class ToTensor(object):
         return torch.from_numpy(cvimage.astype(np.float32)).permute(2, 0, 1), boxes, labels
 
 
+class ToUint8Tensor(object):
+    def __call__(self, cvimage, boxes=None, labels=None):
+        image = np.rint(np.clip(cvimage, 0, 255)).astype(np.uint8)
+        return torch.from_numpy(image).permute(2, 0, 1), boxes, labels
+
+
 class RandomSampleCrop(object):
     """Crop
     Arguments: